@@ -1,12 +1,18 @@
-import json
+import asyncio
+import atexit
+import heapq
+import itertools
+import logging
+import logging.handlers
+import queue
 import sys
 import random
-import time
-import threading
 import re
-from datetime import datetime
-from http.client import HTTPSConnection
-from typing import Dict, List
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import httpx
+import orjson
 import pandas as pd
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
@@ -14,19 +20,38 @@ from googleapiclient.errors import HttpError
 
 CREDENTIALS_FILE = "credentials.json"  # Google Sheets API credentials
 
+logger = logging.getLogger(__name__)
+
+# Retry policy for sends the server reports as not processed; creating a
+# message is not idempotent, so statuses like 502/504 are never retried
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.2  # Seconds, doubled after each attempt
+RETRY_STATUSES = frozenset({429, 503})
+
+USER_RATE_LIMIT = 50  # Requests per second Discord allows for a single token
+MAX_CONCURRENT_SENDS = 64  # Send workers; each holds one send, including time spent waiting for a bucket slot
+
+# Matches either a Sheets URL (".../spreadsheets/d/<id>") or a bare sheet ID
+SHEET_ID_PATTERN = re.compile(r"spreadsheets/d/([a-zA-Z0-9-_]+)|^([a-zA-Z0-9-_]+)$")
+
+# Header row the sheet template must start with
+EXPECTED_HEADERS = (
+    "User ID", "User Alias", "Token", "Channel URL",
+    "Channel ID", "Channel Alias", "Messages", "Delay"
+)
+EXPECTED_HEADERS_LOWER = tuple(header.lower() for header in EXPECTED_HEADERS)
+
+# Column names used for the sheet data, in template order
+SHEET_COLUMNS = [
+    "user_id", "user_alias", "token", "channel_url",
+    "channel_id", "channel_alias", "messages", "delay"
+]
+
 def extract_sheet_id_from_url(url: str) -> str:
     """Extract the Google Sheets ID from a URL"""
-    # Pattern for different Google Sheets URL formats
-    patterns = [
-        r"/spreadsheets/d/([a-zA-Z0-9-_]+)",  # Standard URL
-        r"spreadsheets/d/([a-zA-Z0-9-_]+)",   # Modified URL
-        r"^([a-zA-Z0-9-_]+)$"                 # Direct ID
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            return match.group(1)
+    match = SHEET_ID_PATTERN.search(url)
+    if match:
+        return match.group(1) or match.group(2)
     
     raise ValueError("Invalid Google Sheets URL format")
 
@@ -44,72 +69,104 @@ def get_sheet_url_from_user() -> str:
             print("Invalid URL format. Please try again.")
             continue
 
+@dataclass(slots=True, frozen=True)
 class ChannelConfig:
-    def __init__(self, url: str, id: str, alias: str, messages: List[str], delay: float):
-        self.url = url
-        self.id = id
-        self.alias = alias
-        self.messages = messages
-        self.delay = delay
-
-    @classmethod
-    def from_sheet_row(cls, row_data: List[str]):
-        messages = [msg.strip() for msg in row_data[6].split(',') if msg.strip()]
-        return cls(
-            url=row_data[3],
-            id=row_data[4],
-            alias=row_data[5] if row_data[5] else row_data[4],
-            messages=messages,
-            delay=float(row_data[7])
-        )
+    url: str
+    id: str
+    alias: str
+    messages: Tuple[str, ...]
+    delay: float
+    path: str = field(init=False)
+    # Derived from url and unhashable, so left out of eq and hash
+    headers: Dict[str, str] = field(init=False, compare=False)
+    encoded_messages: Tuple[bytes, ...] = field(init=False)
+
+    def __post_init__(self):
+        # Request parts never change for a channel, so build them once up front
+        object.__setattr__(self, "path", f"/api/v10/channels/{self.id}/messages")
+        object.__setattr__(self, "headers", {"referrer": self.url})
+        object.__setattr__(self, "encoded_messages", tuple(orjson.dumps({"content": message}) for message in self.messages))
+
+class TokenBucket:
+    """Hands out a fixed number of send slots per period, refilling continuously"""
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
 
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+@dataclass(slots=True)
 class UserConfig:
-    def __init__(self, user_id: str, token: str, channels: List[ChannelConfig], alias: str):
-        self.user_id = user_id
-        self.token = token
-        self.channels = channels
-        self.alias = alias
+    user_id: str
+    token: str = field(repr=False)  # Discord auth token, kept out of reprs
+    channels: List[ChannelConfig]
+    alias: str
+    # Shared by all of the user's channels so any ready channel can use a free slot
+    bucket: TokenBucket = field(
+        init=False, repr=False, default_factory=lambda: TokenBucket(USER_RATE_LIMIT, 1.0)
+    )
 
     def get_display_name(self) -> str:
         return self.alias if self.alias else self.user_id
 
-def get_timestamp() -> str:
-    return "[" + str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "]"
+class CachedTimeFormatter(logging.Formatter):
+    """Formatter that renders the timestamp once per wall-clock second"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cached_time = (None, "")
 
-def precise_sleep(duration: float, randomize: bool = False, min_random: float = 0, max_random: float = 0):
-    if randomize:
-        sleep_duration = duration + random.uniform(min_random, max_random)
-    else:
-        sleep_duration = duration
-        
-    start_time = time.perf_counter()
-    while (time.perf_counter() - start_time) < sleep_duration:
-        remaining = sleep_duration - (time.perf_counter() - start_time)
-        if remaining > 0.1:
-            time.sleep(0.1)
+    def formatTime(self, record: logging.LogRecord, datefmt: Optional[str] = None) -> str:
+        # Without a datefmt the base class appends milliseconds, which differ within a second
+        if not datefmt:
+            return super().formatTime(record, datefmt)
+        key = (int(record.created), datefmt)
+        if self._cached_time[0] != key:
+            self._cached_time = (key, super().formatTime(record, datefmt))
+        return self._cached_time[1]
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Route log records through a queue so only a background thread writes to stdout"""
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(CachedTimeFormatter("[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+def get_delay(duration: float, randomize: bool = False, min_random: float = 0, max_random: float = 0) -> float:
+    return duration + (random.uniform(min_random, max_random) if randomize else 0)
 
 def validate_sheet_structure(values: List[List[str]]) -> bool:
     """Validate that the sheet has the correct structure"""
-    expected_headers = [
-        "User ID", "User Alias", "Token", "Channel URL", 
-        "Channel ID", "Channel Alias", "Messages", "Delay"
-    ]
-    
     if not values or len(values) < 2:  # At least headers and one data row
         print("Error: Sheet is empty")
         return False
         
     headers = values[0]
-    if len(headers) < len(expected_headers):
+    if len(headers) < len(EXPECTED_HEADERS):
         print("Error: Missing columns in sheet")
-        print("Expected columns:", expected_headers)
+        print("Expected columns:", list(EXPECTED_HEADERS))
         print("Found columns:", headers)
         return False
         
-    for expected, found in zip(expected_headers, headers):
-        if expected.lower() != found.lower():
-            print(f"Error: Expected column '{expected}', found '{found}'")
-            return False
+    lowered = tuple(found.lower() for found in headers[:len(EXPECTED_HEADERS)])
+    if lowered != EXPECTED_HEADERS_LOWER:
+        i = next(i for i, (expected, found) in enumerate(zip(EXPECTED_HEADERS_LOWER, lowered)) if expected != found)
+        print(f"Error: Expected column '{EXPECTED_HEADERS[i]}', found '{headers[i]}'")
+        return False
             
     return True
 
@@ -138,30 +195,46 @@ def load_from_sheets(sheet_id: str) -> List[UserConfig]:
         if not validate_sheet_structure(values):
             return []
 
-        # Process the data (skip header row)
-        users = {}
-        for row in values[1:]:  # Skip header row
-            # Ensure row has all required fields
-            if len(row) < 8:
-                print(f"Skipping incomplete row: {row}")
-                continue
+        # Process the data (skip header row), keeping only the template columns
+        df = pd.DataFrame(values[1:]).reindex(columns=range(len(SHEET_COLUMNS)))
+        df.columns = SHEET_COLUMNS
 
-            user_id = row[0]
-            
-            # Create new user if not exists
-            if user_id not in users:
-                users[user_id] = UserConfig(
-                    user_id=user_id,
-                    token=row[2],
-                    channels=[],
-                    alias=row[1] if row[1] else user_id
+        # Ensure row has all required fields
+        incomplete = df.isna().any(axis=1)
+        for index in df.index[incomplete]:
+            print(f"Skipping incomplete row: {values[index + 1]}")
+        df = df[~incomplete].copy()
+        if df.empty:
+            return []
+
+        df["messages"] = df["messages"].str.split(",").map(
+            lambda parts: tuple([part for part in map(str.strip, parts) if part])
+        )
+        df["delay"] = df["delay"].astype(float)
+        df["channel_alias"] = df["channel_alias"].where(df["channel_alias"] != "", df["channel_id"])
+
+        # Build one user per distinct User ID, in sheet order
+        users = []
+        for user_id, group in df.groupby("user_id", sort=False):
+            first = group.iloc[0]
+            channels = [
+                ChannelConfig(
+                    url=row.channel_url,
+                    id=row.channel_id,
+                    alias=row.channel_alias,
+                    messages=row.messages,
+                    delay=row.delay
                 )
-            
-            # Add channel to user
-            channel = ChannelConfig.from_sheet_row(row)
-            users[user_id].channels.append(channel)
+                for row in group.itertuples(index=False)
+            ]
+            users.append(UserConfig(
+                user_id=user_id,
+                token=first["token"],
+                channels=channels,
+                alias=first["user_alias"] if first["user_alias"] else user_id
+            ))
 
-        return list(users.values())
+        return users
 
     except HttpError as e:
         print(f"Error accessing Google Sheets: {e}")
@@ -172,68 +245,158 @@ def load_from_sheets(sheet_id: str) -> List[UserConfig]:
         print(f"Error loading Google Sheets: {e}")
         return []
 
-def send_message(user: UserConfig, channel: ChannelConfig, message: str):
-    try:
-        header_data = {
+Sender = Callable[[bytes, int], Awaitable[Tuple[float, bool]]]
+Job = Tuple[Sender, UserConfig, ChannelConfig]
+
+def create_user_client(user: UserConfig) -> httpx.AsyncClient:
+    """Create an HTTP/2 client carrying the user's auth headers"""
+    # All of a user's channels multiplex their requests over this client's connection
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+            retries=RETRY_TOTAL  # Retry failed connection attempts
+        ),
+        base_url="https://discord.com",
+        headers={
             "content-type": "application/json",
             "user-id": user.user_id,
-            "authorization": user.token,
-            "host": "discordapp.com",
-            "referrer": channel.url
+            "authorization": user.token
         }
-        
-        message_data = json.dumps({"content": message})
-        conn = HTTPSConnection("discordapp.com", 443)
-        
-        conn.request("POST", f"/api/v6/channels/{channel.id}/messages", message_data, header_data)
-        resp = conn.getresponse()
-        
-        if 199 < resp.status < 300:
-            print(f"{get_timestamp()} User {user.get_display_name()} sent message to channel {channel.alias}")
-        else:
-            print(f"{get_timestamp()} Failed to send message for user {user.get_display_name()} in channel {channel.alias}: Status {resp.status}")
-            
-        conn.close()
-    except Exception as e:
-        print(f"{get_timestamp()} Error sending message for user {user.get_display_name()} in channel {channel.alias}: {e}")
+    )
 
-def channel_message_loop(user: UserConfig, channel: ChannelConfig):
-    """Function to handle message sending for a single channel"""
-    while True:
-        print(f"{get_timestamp()} User {user.get_display_name()} starting messages for channel {channel.alias}")
-        for message in channel.messages:
-            send_message(user, channel, message)
-            precise_sleep(channel.delay)
-        print(f"{get_timestamp()} User {user.get_display_name()} completed message cycle for channel {channel.alias}")
-        precise_sleep(1.0)  # Short sleep between cycles
-
-def user_message_loop(user: UserConfig):
-    """Function to handle message sending for a single user across all channels in parallel"""
-    channel_threads = []
-    
-    # Create a thread for each channel
-    for channel in user.channels:
-        thread = threading.Thread(
-            target=channel_message_loop,
-            args=(user, channel),
-            daemon=True
-        )
-        channel_threads.append(thread)
-    
-    # Start all channel threads
-    for thread in channel_threads:
-        thread.start()
+def get_retry_delay(retry_after: Optional[str], attempt: int) -> float:
+    """Wait as long as Discord asks, otherwise back off exponentially"""
+    try:
+        return max(0.0, float(retry_after))
+    except (TypeError, ValueError):
+        # Missing, or sent as an HTTP-date rather than seconds
+        return RETRY_BACKOFF * 2 ** attempt
+
+def make_sender(client: httpx.AsyncClient, user: UserConfig, channel: ChannelConfig) -> Sender:
+    """Bind a channel's request state once and return a coroutine that sends one body"""
+    post = client.post
+    acquire = user.bucket.acquire
+    path = channel.path
+    headers = channel.headers
+    user_name = user.get_display_name()
+    channel_alias = channel.alias
+
+    async def send_message(body: bytes, attempt: int) -> Tuple[float, bool]:
+        """Send one message and return how long the channel must wait, and whether to resend it"""
+        try:
+            await acquire()
+            resp = await post(path, content=body, headers=headers)
+            if resp.status_code in RETRY_STATUSES and attempt < RETRY_TOTAL:
+                # Hand the wait back to the dispatcher rather than holding a worker through it
+                return get_retry_delay(resp.headers.get("retry-after"), attempt), True
+
+            if 199 < resp.status_code < 300:
+                logger.info("User %s sent message to channel %s", user_name, channel_alias)
+            else:
+                logger.warning("Failed to send message for user %s in channel %s: Status %s", user_name, channel_alias, resp.status_code)
+
+            # Once the bucket is drained, hold the channel until Discord resets it
+            if resp.headers.get("x-ratelimit-remaining") == "0":
+                return float(resp.headers.get("x-ratelimit-reset-after", 0)), False
+        except Exception as e:
+            logger.error("Error sending message for user %s in channel %s: %s", user_name, channel_alias, e)
+        return 0.0, False
+
+    return send_message
+
+async def dispatch_messages(jobs: List[Job]):
+    """Drive the sends of every channel from a single timer feeding a pool of workers"""
+    loop = asyncio.get_running_loop()
+    timer = None  # Single timer handle, always armed for the earliest heap entry
+    order = itertools.count()  # Tie-breaker so equal fire times never compare jobs
+    heap = []
+    due = asyncio.Queue()
+
+    def arm_timer():
+        nonlocal timer
+        if timer is not None:
+            timer.cancel()
+        timer = loop.call_at(heap[0][0], release_due) if heap else None
+
+    def release_due():
+        nonlocal timer
+        timer = None
+        now = loop.time()
+        while heap and heap[0][0] <= now:
+            _, _, job, index, attempt = heapq.heappop(heap)
+            if index == 0 and attempt == 0:
+                _, user, channel = job
+                logger.info("User %s starting messages for channel %s", user.get_display_name(), channel.alias)
+            due.put_nowait((job, index, attempt))
+        arm_timer()
+
+    def schedule(fire_at: float, job: Job, index: int, attempt: int = 0):
+        entry = (fire_at, next(order), job, index, attempt)
+        heapq.heappush(heap, entry)
+        # Only a new earliest entry moves the timer
+        if heap[0] is entry:
+            arm_timer()
+
+    async def worker():
+        while True:
+            job, index, attempt = await due.get()
+            send, user, channel = job
+            wait, resend = await send(channel.encoded_messages[index], attempt)
+            if resend:
+                schedule(loop.time() + wait, job, index, attempt + 1)
+                continue
+            delay = max(get_delay(channel.delay), wait)
+            index += 1
+            if index == len(channel.encoded_messages):
+                logger.info("User %s completed message cycle for channel %s", user.get_display_name(), channel.alias)
+                delay += get_delay(1.0)  # Short sleep between cycles
+                index = 0
+            schedule(loop.time() + delay, job, index)
+
+    # A channel is never queued twice at once, so more workers than channels would sit idle
+    workers = [
+        asyncio.create_task(worker())
+        for _ in range(max(1, min(MAX_CONCURRENT_SENDS, len(jobs))))
+    ]
+    for job in jobs:
+        schedule(loop.time(), job, 0)
+
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        if timer is not None:
+            timer.cancel()
+        for task in workers:
+            task.cancel()
+
+async def run_message_loops(users: List[UserConfig]):
+    """Run every channel of every user concurrently on a single event loop"""
+    clients = [create_user_client(user) for user in users]
+    try:
+        await dispatch_messages([
+            (make_sender(client, user, channel), user, channel)
+            for client, user in zip(clients, users)
+            for channel in user.channels
+            if channel.encoded_messages
+        ])
+    finally:
+        for client in clients:
+            await client.aclose()
 
 def show_configuration_summary(users: List[UserConfig]):
-    print("\nCurrent Configuration Summary:")
+    lines = ["\nCurrent Configuration Summary:"]
     for user in users:
-        print(f"\nUser: {user.get_display_name()} (ID: {user.user_id})")
+        lines.append(f"\nUser: {user.get_display_name()} (ID: {user.user_id})")
         for channel in user.channels:
-            print(f"  Channel: {channel.alias} (ID: {channel.id})")
-            print(f"    Delay: {channel.delay} seconds")
-            print(f"    Messages ({len(channel.messages)}):")
+            lines.append(f"  Channel: {channel.alias} (ID: {channel.id})")
+            lines.append(f"    Delay: {channel.delay} seconds")
+            lines.append(f"    Messages ({len(channel.messages)}):")
             for i, msg in enumerate(channel.messages, 1):
-                print(f"      {i}. {msg}")
+                lines.append(f"      {i}. {msg}")
+    # Write the whole summary at once instead of one print per line
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
 
 def show_help():
     print("Discord Multi-User Auto Messenger Help")
@@ -256,33 +419,23 @@ def main():
         show_help()
         return
 
+    listener = setup_logging()
+    atexit.register(listener.stop)  # Flush queued log lines on exit
+
     sheet_id = get_sheet_url_from_user()
     users = load_from_sheets(sheet_id)
     
     if not users:
-        print(f"{get_timestamp()} No users configured. Please check your Google Sheets configuration.")
+        logger.info("No users configured. Please check your Google Sheets configuration.")
         return
 
     show_configuration_summary(users)
     
-    user_threads = []
-    for user in users:
-        thread = threading.Thread(
-            target=user_message_loop,
-            args=(user,),
-            daemon=True
-        )
-        user_threads.append(thread)
-
-    print(f"{get_timestamp()} Starting message sending for all users simultaneously...")
-    for thread in user_threads:
-        thread.start()
-
+    logger.info("Starting message sending for all users simultaneously...")
     try:
-        while True:
-            time.sleep(1)
+        asyncio.run(run_message_loops(users))
     except KeyboardInterrupt:
-        print(f"\n{get_timestamp()} Received shutdown signal. Waiting for threads to complete...")
+        logger.info("Received shutdown signal. Stopping message loops...")
         sys.exit(0)
 
 if __name__ == "__main__":